@@ -1,15 +1,46 @@
 from flask import Flask, render_template, request, redirect, url_for, flash, send_file
-from datetime import date, datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date
 from PIL import Image, UnidentifiedImageError
-from typing import Dict, Tuple
+from typing import Dict, List, Optional, Tuple
 from io import BytesIO
+import numpy as np
+import subprocess
+import multiprocessing
+import threading
+import heapq
+import atexit
+import time
+import tempfile
+import shutil
 import uuid
 import os
 
+try:
+    # optional: lossless mozjpeg post-pass for JPEG output (smaller files, same pixels)
+    import mozjpeg_lossless_optimization
+except ImportError:
+    mozjpeg_lossless_optimization = None
+
+try:
+    # optional: shared download store for multi-worker deployments (see REDIS_URL)
+    import redis
+except ImportError:
+    redis = None
+
 # -----------------------
 # Configuration
 # -----------------------
 ALLOWED_OUTPUT_FORMATS = {"JPEG", "PNG", "WEBP"}
+# output format -> (file extension, MIME type)
+OUTPUT_EXT_AND_MIME = {
+    "JPEG": ("jpg", "image/jpeg"),
+    "PNG": ("png", "image/png"),
+    "WEBP": ("webp", "image/webp"),
+}
+# sorted once for the format <select> in the template
+ALLOWED_OUTPUT_FORMATS_SORTED = sorted(ALLOWED_OUTPUT_FORMATS)
 DEFAULT_QUALITY = 40
 MAX_QUALITY = 100
 MIN_QUALITY = 1
@@ -17,9 +48,62 @@ MIN_QUALITY = 1
 # limit uploads to 10 MB (adjust if needed)
 MAX_CONTENT_LENGTH = 10 * 1024 * 1024
 
-# how long to keep compressed image bytes in memory (seconds)
+# limit decoded image size (pixels); a small compressed file can still
+# expand to gigabytes of pixel data ("decompression bomb")
+MAX_IMAGE_PIXELS = 40_000_000  # 40 MP
+
+# Pillow PNG compress_level (0-9) for each quality 0-100, higher quality => lower compression:
+# compress_level = round((100 - quality) / 11.111...) clamped to 0-9
+PNG_COMPRESS_LEVELS = tuple(max(0, min(9, round((100 - q) / (100 / 9)))) for q in range(MAX_QUALITY + 1))
+
+# long-edge cap applied when the user leaves "downscale" on (aspect ratio is kept)
+MAX_OUTPUT_DIMENSION = 2560
+
+# how long to keep compressed images available for download (seconds)
 DOWNLOAD_CACHE_TTL_SECONDS = 300  # 5 minutes
 
+# where compressed images are spooled until downloaded; tmpfs keeps them out of
+# the Python heap while letting the kernel page them out under memory pressure
+DOWNLOAD_SPOOL_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+# spooled files are named <prefix><download_id>.<ext>; files with this prefix
+# older than the TTL are treated as leftovers (e.g. from a killed worker)
+SPOOL_FILE_PREFIX = "image_compressor_"
+
+# when set (e.g. redis://localhost:6379/0), downloads are kept in Redis so any
+# worker process can serve them; otherwise they stay local to this process
+REDIS_URL = os.environ.get("REDIS_URL")
+REDIS_KEY_PREFIX = "image_compressor:dl:"
+
+# background colour used when flattening transparency for formats without alpha
+FLATTEN_BACKGROUND = (255, 255, 255)
+
+# external PNG optimizers (used only when found on PATH)
+PNGQUANT_BIN = shutil.which("pngquant")
+OXIPNG_BIN = shutil.which("oxipng")
+PNG_TOOL_TIMEOUT_SECONDS = 30
+
+# adaptive JPEG quality (opt-in per request): binary-search down to
+# ADAPTIVE_QUALITY_RANGE below the requested quality, keeping the smallest
+# encode whose SSIM against the source stays above the threshold
+ADAPTIVE_QUALITY_RANGE = 20
+ADAPTIVE_SSIM_THRESHOLD = 0.97
+ADAPTIVE_MAX_ITERATIONS = 4
+# SSIM is computed at native resolution (where JPEG block artifacts show) on a
+# SSIM_CROP_GRID x SSIM_CROP_GRID grid of SSIM_CROP_SIZE-pixel luma crops
+SSIM_CROP_SIZE = 256
+SSIM_CROP_GRID = 4
+
+# number of processes that decode/encode images off the request thread
+ENCODE_WORKERS = os.cpu_count() or 1
+# how long a request waits for its encode before giving up on it (seconds)
+ENCODE_TIMEOUT_SECONDS = 120
+# start encoder processes from a clean server process instead of forking the
+# (multi-threaded) web process; they re-import this module, so the settings
+# above apply there too
+ENCODE_MP_CONTEXT = multiprocessing.get_context(
+    "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+)
+
 # optional debug and port
 DEBUG = True
 DEFAULT_PORT = 5000
@@ -31,38 +115,372 @@ app = Flask(__name__)
 app.secret_key = os.environ.get("SECRET_KEY") or os.urandom(24)
 
 app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
+# Pillow refuses to open images far beyond this limit (workers set it on import too)
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# CPU-bound Pillow work runs here so it doesn't hold the GIL of the serving process;
+# started on first use (see _get_encode_pool) so importing the module stays cheap,
+# including in the encoder processes themselves
+app.encode_pool: Optional[ProcessPoolExecutor] = None
+# processes per pool; deployments can lower it per server process (see gunicorn_conf.py)
+app.encode_pool_size = ENCODE_WORKERS
+app.encode_pool_lock = threading.Lock()
+
+# Shared download store (Redis expires keys itself, so no sweeping is needed)
+if REDIS_URL:
+    if redis is None:
+        raise RuntimeError("REDIS_URL is set but the 'redis' package is not installed.")
+    app.redis = redis.Redis.from_url(REDIS_URL)
+else:
+    app.redis = None
+
+
+class DownloadEntry:
+    """A compressed image waiting to be downloaded (payload lives in DOWNLOAD_SPOOL_DIR)."""
+
+    __slots__ = ("path", "mimetype", "filename", "expiry")
 
-# In-memory download cache:
-# mapping download_id -> (bytes, mimetype, filename, expiry_datetime)
-DownloadEntry = Tuple[bytes, str, str, datetime]
+    def __init__(self, path: str, mimetype: str, filename: str, expiry: float) -> None:
+        self.path = path
+        self.mimetype = mimetype
+        self.filename = filename
+        self.expiry = expiry
+
+
+# Local download cache (used without Redis): mapping download_id -> DownloadEntry
 app.download_cache: Dict[str, DownloadEntry] = {}
+# min-heap of (expiry_monotonic, download_id) so cleanup only touches expired entries
+app.expiry_heap: List[Tuple[float, str]] = []
+# next time (monotonic) the spool dir is scanned for leftovers; 0 => on first request
+app.next_spool_sweep = 0.0
 
 # -----------------------
 # Helpers
 # -----------------------
 def _cleanup_expired_cache() -> None:
-    """Remove expired entries from app.download_cache. Called during requests."""
-    now = datetime.utcnow()
-    expired = [k for k, (_, _, _, expiry) in app.download_cache.items() if expiry <= now]
-    for k in expired:
-        app.download_cache.pop(k, None)
+    """Remove expired entries from app.download_cache. Called during requests.
+
+    Only the local cache needs this; Redis expires its keys on its own.
+    """
+    now = time.monotonic()
+    heap = app.expiry_heap
+    while heap and heap[0][0] <= now:
+        _, k = heapq.heappop(heap)
+        # entry may already be gone if it was downloaded
+        entry = app.download_cache.pop(k, None)
+        if entry is not None:
+            _remove_spooled_file(entry.path)
+
+    # other processes' leftovers: scan the spool dir at most once per TTL
+    if app.redis is None and now >= app.next_spool_sweep:
+        app.next_spool_sweep = now + DOWNLOAD_CACHE_TTL_SECONDS
+        _sweep_stale_spool_files()
+
+
+def _sweep_stale_spool_files() -> None:
+    """Delete spooled files older than the TTL, e.g. left behind by a killed or recycled worker."""
+    cutoff = time.time() - DOWNLOAD_CACHE_TTL_SECONDS
+    try:
+        with os.scandir(DOWNLOAD_SPOOL_DIR) as entries:
+            for item in entries:
+                if not item.name.startswith(SPOOL_FILE_PREFIX):
+                    continue
+                try:
+                    if item.is_file() and item.stat().st_mtime < cutoff:
+                        _remove_spooled_file(item.path)
+                except OSError:
+                    pass
+    except OSError:
+        pass
+
+
+def _remove_local_downloads() -> None:
+    """Delete this process's spooled files on interpreter exit."""
+    for entry in app.download_cache.values():
+        _remove_spooled_file(entry.path)
+    app.download_cache.clear()
+
+
+atexit.register(_remove_local_downloads)
+
+
+def _remove_spooled_file(path: str) -> None:
+    """Delete a spooled download file; best effort (it may already be gone)."""
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+
+def _store_download(download_id: str, data: bytes, ext: str, mimetype: str, filename: str) -> None:
+    """Keep compressed bytes available for DOWNLOAD_CACHE_TTL_SECONDS.
+
+    Uses Redis when configured, otherwise spools to DOWNLOAD_SPOOL_DIR and
+    registers the file in app.download_cache.
+    """
+    if app.redis is not None:
+        key = REDIS_KEY_PREFIX + download_id
+        pipe = app.redis.pipeline()
+        pipe.hset(key, mapping={"data": data, "mimetype": mimetype, "filename": filename})
+        pipe.expire(key, DOWNLOAD_CACHE_TTL_SECONDS)
+        pipe.execute()
+        return
+
+    path = os.path.join(DOWNLOAD_SPOOL_DIR, f"{SPOOL_FILE_PREFIX}{download_id}.{ext}")
+    # owner-only: the spool dir (e.g. /dev/shm) is listable by every local user
+    with os.fdopen(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), "wb") as fh:
+        fh.write(data)
+
+    # monotonic seconds: cheap float compares and immune to wall-clock jumps
+    expiry = time.monotonic() + DOWNLOAD_CACHE_TTL_SECONDS
+    app.download_cache[download_id] = DownloadEntry(path, mimetype, filename, expiry)
+    heapq.heappush(app.expiry_heap, (expiry, download_id))
+
+
+def _pop_redis_download(download_id: str) -> Optional[Tuple[bytes, str, str]]:
+    """Fetch and delete a download from Redis in one transaction.
+
+    Returns (data, mimetype, filename), or None if it's missing/expired.
+    """
+    key = REDIS_KEY_PREFIX + download_id
+    pipe = app.redis.pipeline()  # MULTI/EXEC, so only one request can claim it
+    pipe.hgetall(key)
+    pipe.delete(key)
+    fields, _ = pipe.execute()
+    if not fields:
+        return None
+    return fields[b"data"], fields[b"mimetype"].decode(), fields[b"filename"].decode()
+
+
+def _get_encode_pool() -> ProcessPoolExecutor:
+    """Return this process's encode pool, starting it on first use."""
+    with app.encode_pool_lock:
+        if app.encode_pool is None:
+            app.encode_pool = ProcessPoolExecutor(max_workers=app.encode_pool_size, mp_context=ENCODE_MP_CONTEXT)
+        return app.encode_pool
+
+
+def _discard_encode_pool(pool: ProcessPoolExecutor, terminate: bool = False) -> None:
+    """Drop `pool` so the next request starts a fresh one.
+
+    With `terminate`, also kill its processes (e.g. one is stuck on an image);
+    other requests still using the pool then fail with BrokenProcessPool.
+    """
+    with app.encode_pool_lock:
+        if app.encode_pool is pool:
+            app.encode_pool = None
+    if terminate:
+        # the executor has no public API for killing running workers
+        for proc in list(getattr(pool, "_processes", {}).values()):
+            proc.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
 
 
 def _generate_download_id() -> str:
     return uuid.uuid4().hex
 
 
-def _safe_output_extension(fmt: str) -> str:
-    """Return common file extension for the chosen output format."""
-    fmt = fmt.upper()
-    if fmt == "JPEG":
-        return "jpg"
-    if fmt == "PNG":
-        return "png"
-    if fmt == "WEBP":
-        return "webp"
-    # fallback
-    return fmt.lower()
+def _flatten_alpha(img: Image.Image, background: Tuple[int, int, int] = FLATTEN_BACKGROUND) -> Image.Image:
+    """Alpha-blend an RGBA/P image onto a solid background and return it as RGB.
+
+    Uses Pillow's alpha_composite, which stays in 8-bit buffers (no wide temporaries
+    for large images).
+    """
+    rgba = img.convert("RGBA")
+    base = Image.new("RGBA", rgba.size, tuple(background) + (255,))
+    return Image.alpha_composite(base, rgba).convert("RGB")
+
+
+def _optimize_png(png_bytes: bytes, quality: int) -> Tuple[bytes, bool]:
+    """Shrink PNG bytes with pngquant (lossy palette) then oxipng (lossless DEFLATE).
+
+    Each stage is skipped if its binary is missing or it fails (pngquant exits
+    non-zero when the requested quality can't be met or the result would be
+    larger), keeping the previous bytes. Returns (bytes, whether pngquant's
+    output was used).
+    """
+    quantized = False
+    if PNGQUANT_BIN:
+        try:
+            proc = subprocess.run(
+                [
+                    PNGQUANT_BIN,
+                    f"--quality={max(0, quality - 10)}-{quality}",
+                    "--speed",
+                    "3",
+                    "--skip-if-larger",
+                    "-",
+                ],
+                input=png_bytes,
+                capture_output=True,
+                check=True,
+                timeout=PNG_TOOL_TIMEOUT_SECONDS,
+            )
+            png_bytes = proc.stdout
+            quantized = True
+        except (OSError, subprocess.SubprocessError):
+            pass
+
+    if OXIPNG_BIN:
+        try:
+            proc = subprocess.run(
+                [OXIPNG_BIN, "-o", "2", "--stdout", "-"],
+                input=png_bytes,
+                capture_output=True,
+                check=True,
+                timeout=PNG_TOOL_TIMEOUT_SECONDS,
+            )
+            png_bytes = proc.stdout
+        except (OSError, subprocess.SubprocessError):
+            pass
+
+    return png_bytes, quantized
+
+
+def _luma_crops(img: Image.Image) -> List[np.ndarray]:
+    """Return native-resolution float32 luma crops of `img` for SSIM comparisons.
+
+    Crops sit on an evenly spaced grid with origins on the 8px JPEG block grid.
+    """
+    gray = img.convert("L")
+    width, height = gray.size
+    size = min(SSIM_CROP_SIZE, width, height)
+    xs = sorted({x // 8 * 8 for x in np.linspace(0, width - size, SSIM_CROP_GRID).astype(int)})
+    ys = sorted({y // 8 * 8 for y in np.linspace(0, height - size, SSIM_CROP_GRID).astype(int)})
+    return [np.asarray(gray.crop((x, y, x + size, y + size)), dtype=np.float32) for y in ys for x in xs]
+
+
+def _ssim(a: np.ndarray, b: np.ndarray, block: int = 8) -> float:
+    """Mean SSIM of two equally sized luma arrays over block x block windows.
+
+    Windows are taken on the block grid and again shifted by half a block, so
+    discontinuities at JPEG block edges are measured too.
+    """
+    block = max(1, min(block, a.shape[0], a.shape[1]))
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    scores = []
+    for offset in {0, block // 2}:
+        h = (a.shape[0] - offset) // block * block
+        w = (a.shape[1] - offset) // block * block
+        if h == 0 or w == 0:
+            continue
+
+        def windows(x: np.ndarray) -> np.ndarray:
+            x = x[offset:offset + h, offset:offset + w].reshape(h // block, block, w // block, block)
+            return x.swapaxes(1, 2).reshape(-1, block * block)
+
+        wa, wb = windows(a), windows(b)
+        mu_a, mu_b = wa.mean(axis=1), wb.mean(axis=1)
+        var_a, var_b = wa.var(axis=1), wb.var(axis=1)
+        cov = ((wa - mu_a[:, None]) * (wb - mu_b[:, None])).mean(axis=1)
+        ssim = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))
+        scores.append(ssim.mean())
+    return float(np.mean(scores))
+
+
+def _encode_at_q(img: Image.Image, out_format: str, quality: int, png_recompressed: bool = False) -> bytes:
+    """Save `img` with Pillow in `out_format` at the given quality and return the bytes.
+
+    `png_recompressed` means pngquant will re-encode the PNG, so Pillow only does a fast zlib pass.
+    """
+    img_io = BytesIO()
+    save_kwargs = {"format": out_format}
+    # JPEG/WEBP accept quality; PNG uses 'optimize' / compress_level if needed
+    if out_format in ("JPEG", "WEBP"):
+        save_kwargs["quality"] = quality
+        # mozjpeg redoes the Huffman optimization losslessly, so skip Pillow's pass when it's available
+        if out_format == "WEBP" or mozjpeg_lossless_optimization is None:
+            save_kwargs["optimize"] = True
+        if out_format == "JPEG":
+            # progressive scans are usually a few percent smaller than baseline
+            save_kwargs["progressive"] = True
+        if out_format == "WEBP":
+            # lossy WebP still carries the alpha channel
+            save_kwargs["lossless"] = False
+    elif out_format == "PNG":
+        if png_recompressed:
+            save_kwargs["compress_level"] = 1
+        else:
+            save_kwargs["optimize"] = True
+            save_kwargs["compress_level"] = PNG_COMPRESS_LEVELS[quality]
+
+    img.save(img_io, **save_kwargs)
+    return img_io.getvalue()
+
+
+def _encode_jpeg_adaptive(img: Image.Image, quality: int) -> Tuple[bytes, int]:
+    """Encode `img` as JPEG at the lowest quality (down to ADAPTIVE_QUALITY_RANGE below
+    `quality`) whose decoded result still reaches ADAPTIVE_SSIM_THRESHOLD.
+
+    Returns (bytes, quality used); falls back to a plain encode at `quality` if no
+    candidate passes.
+    """
+    reference = _luma_crops(img)
+    lo, hi = max(MIN_QUALITY, quality - ADAPTIVE_QUALITY_RANGE), quality
+    best, best_q = None, quality
+    for _ in range(ADAPTIVE_MAX_ITERATIONS):
+        if lo > hi:
+            break
+        q = (lo + hi) // 2
+        candidate = _encode_at_q(img, "JPEG", q)
+        decoded = _luma_crops(Image.open(BytesIO(candidate)))
+        score = float(np.mean([_ssim(a, b) for a, b in zip(reference, decoded)]))
+        if score >= ADAPTIVE_SSIM_THRESHOLD:
+            if best is None or len(candidate) < len(best):
+                best, best_q = candidate, q
+            hi = q - 1
+        else:
+            lo = q + 1
+
+    if best is None:
+        best = _encode_at_q(img, "JPEG", quality)
+    return best, best_q
+
+
+def _encode_worker(
+    raw_bytes: bytes, out_format: str, quality: int, adaptive: bool = False, downscale: bool = False
+) -> Tuple[bytes, int]:
+    """Decode the uploaded bytes and re-encode them in `out_format`.
+
+    Returns (compressed bytes, quality actually used). Runs inside app.encode_pool,
+    so it must stay a top-level function (picklable).
+    """
+    img = Image.open(BytesIO(raw_bytes))
+    if downscale and max(img.size) > MAX_OUTPUT_DIMENSION:
+        # Pillow resizes "P"/"1" images nearest-neighbour regardless of the filter,
+        # so move them to a mode LANCZOS actually applies to
+        if img.mode == "1":
+            img = img.convert("L")
+        elif img.mode == "P":
+            img = img.convert("RGBA" if "transparency" in img.info else "RGB")
+        # thumbnail() lets the JPEG decoder scale down while decoding (draft mode)
+        img.thumbnail((MAX_OUTPUT_DIMENSION, MAX_OUTPUT_DIMENSION), Image.Resampling.LANCZOS)
+    # single decode pass; surfaces truncated/corrupt pixel data
+    img.load()
+
+    # convert if necessary (e.g. PNG alpha -> RGB for JPEG; PNG and WebP keep alpha)
+    if img.mode in ("RGBA", "P") and out_format == "JPEG":
+        img = _flatten_alpha(img)
+
+    used_quality = quality
+    if out_format == "JPEG" and adaptive:
+        compressed_bytes, used_quality = _encode_jpeg_adaptive(img, quality)
+    else:
+        compressed_bytes = _encode_at_q(img, out_format, quality, png_recompressed=PNGQUANT_BIN is not None)
+
+    if out_format == "JPEG" and mozjpeg_lossless_optimization is not None:
+        try:
+            compressed_bytes = mozjpeg_lossless_optimization.optimize(compressed_bytes)
+        except Exception:
+            # keep Pillow's output if the post-pass fails for any reason
+            pass
+    elif out_format == "PNG":
+        compressed_bytes, quantized = _optimize_png(compressed_bytes, quality)
+        if PNGQUANT_BIN and not quantized and not OXIPNG_BIN:
+            # pngquant kept its input, so nothing re-encoded it; do Pillow's full zlib pass after all
+            compressed_bytes = _encode_at_q(img, out_format, quality)
+
+    return compressed_bytes, used_quality
 
 
 # -----------------------
@@ -77,13 +495,14 @@ def index():
         "index.html",
         current_year=date.today().year,
         result=None,
-        allowed_formats=sorted(ALLOWED_OUTPUT_FORMATS),
+        allowed_formats=ALLOWED_OUTPUT_FORMATS_SORTED,
+        max_dimension=MAX_OUTPUT_DIMENSION,
     )
 
 
 @app.route("/compress", methods=["POST"])
 def compress_image():
-    """Handle uploaded image, compress/convert and put result in in-memory cache.
+    """Handle uploaded image, compress/convert and put result in the download cache.
 
     Returns the same index page with `result` containing stats + download id.
     """
@@ -113,62 +532,62 @@ def compress_image():
     # clamp quality to safe range
     quality = max(MIN_QUALITY, min(MAX_QUALITY, quality))
 
-    # compute original file size (in KB) safely from the stream
+    # opt-in content-aware quality search (JPEG only)
+    adaptive = request.form.get("adaptive") == "1"
+    # shrink the long edge to MAX_OUTPUT_DIMENSION (checked by default in the form)
+    downscale = request.form.get("downscale") == "1"
+
+    # buffer the upload once; Image.open only sniffs the header, so a
+    # non-image is rejected here without a separate verify() pass
+    raw = file.stream.read()
+    # everything below works from `raw`; release Werkzeug's (possibly
+    # disk-spilled) upload temp file now rather than after the encode
+    file.close()
+    # original file size (in KB) straight from the buffer; request.content_length
+    # would also count the multipart framing and the other form fields
+    orig_size_kb = len(raw) / 1024.0
     try:
-        # ensure stream at start and measure bytes
-        file.stream.seek(0, os.SEEK_END)
-        orig_bytes = file.stream.tell()
-        file.stream.seek(0)
-        orig_size_kb = orig_bytes / 1024.0
-    except Exception:
-        # fallback (should rarely happen)
-        orig_size_kb = 0.0
-
-    # open and validate with Pillow
-    try:
-        img = Image.open(file.stream)
-        img.verify()  # ensure file is an actual image (raises if not)
+        img = Image.open(BytesIO(raw))
     except UnidentifiedImageError:
         flash("Uploaded file is not a valid image.", "error")
         return redirect(url_for("index"))
+    except Image.DecompressionBombError:
+        # Pillow refuses to even open images over 2x MAX_IMAGE_PIXELS
+        flash(f"Image dimensions are too large. Max allowed: {MAX_IMAGE_PIXELS // 1_000_000} megapixels.", "error")
+        return redirect(url_for("index"))
     except Exception as e:
         flash(f"Error validating image: {e}", "error")
         return redirect(url_for("index"))
 
-    # reopen because verify() leaves the file in an unusable state
-    file.stream.seek(0)
-    try:
-        img = Image.open(file.stream)
-    except Exception as e:
-        flash(f"Cannot open image after verification: {e}", "error")
+    # reject pixel bombs from the header alone, before anything is decoded
+    width, height = img.size
+    if width * height > MAX_IMAGE_PIXELS:
+        flash(
+            f"Image dimensions are too large ({width}x{height}). "
+            f"Max allowed: {MAX_IMAGE_PIXELS // 1_000_000} megapixels.",
+            "error",
+        )
         return redirect(url_for("index"))
 
-    # convert if necessary (e.g. PNG alpha -> RGB for JPEG/WebP)
-    if img.mode in ("RGBA", "P") and out_format != "PNG":
-        img = img.convert("RGB")
-
-    # prepare BytesIO and save compressed image
-    img_io = BytesIO()
-    save_kwargs = {"format": out_format}
-    # JPEG/WEBP accept quality; PNG uses 'optimize' / compress_level if needed
-    if out_format in ("JPEG", "WEBP"):
-        save_kwargs["quality"] = quality
-        save_kwargs["optimize"] = True
-    elif out_format == "PNG":
-        # Pillow uses compress_level (0-9). Map quality 1-100 -> 9-0 (higher quality => lower compression)
-        # We'll compute a simple mapping: compress_level = round((100 - quality) / 11.111...) clamp 0-9
-        compress_level = max(0, min(9, round((100 - quality) / (100 / 9))))
-        save_kwargs["optimize"] = True
-        save_kwargs["compress_level"] = compress_level
-
+    # decode + encode in the process pool
+    pool = _get_encode_pool()
     try:
-        img.save(img_io, **save_kwargs)
+        future = pool.submit(_encode_worker, raw, out_format, quality, adaptive, downscale)
+        compressed_bytes, used_quality = future.result(timeout=ENCODE_TIMEOUT_SECONDS)
+    except BrokenProcessPool:
+        # a worker died (e.g. killed for memory); later requests start a fresh pool
+        _discard_encode_pool(pool)
+        flash("Image processing failed unexpectedly. Please try again.", "error")
+        return redirect(url_for("index"))
+    except FutureTimeoutError:
+        # the encoder is wedged; kill it rather than leave it burning a CPU
+        _discard_encode_pool(pool, terminate=True)
+        flash("Image processing took too long. Please try a smaller image.", "error")
+        return redirect(url_for("index"))
     except Exception as e:
-        flash(f"Error saving compressed image: {e}", "error")
+        flash(f"Error compressing image: {e}", "error")
         return redirect(url_for("index"))
 
-    img_io.seek(0)
-    compressed_bytes = img_io.getvalue()
     compressed_size_kb = len(compressed_bytes) / 1024.0
     # avoid division by zero
     if orig_size_kb > 0:
@@ -176,13 +595,15 @@ def compress_image():
     else:
         compression_percent = 0.0
 
-    # store bytes in in-memory cache with TTL
+    # store the result for download with TTL
     download_id = _generate_download_id()
-    ext = _safe_output_extension(out_format)
+    ext, mimetype = OUTPUT_EXT_AND_MIME[out_format]
     filename = f"compressed.{ext}"
-    mimetype = f"image/{ext if ext != 'jpg' else 'jpeg'}"  # standardize MIME
-    expiry = datetime.utcnow() + timedelta(seconds=DOWNLOAD_CACHE_TTL_SECONDS)
-    app.download_cache[download_id] = (compressed_bytes, mimetype, filename, expiry)
+    try:
+        _store_download(download_id, compressed_bytes, ext, mimetype, filename)
+    except Exception as e:
+        flash(f"Error storing compressed image: {e}", "error")
+        return redirect(url_for("index"))
 
     # prepare result dict for rendering
     result = {
@@ -190,7 +611,9 @@ def compress_image():
         "compressed_kb": round(compressed_size_kb, 2),
         "percent": round(compression_percent, 2),
         "format": out_format,
-        "quality": quality,
+        "quality": used_quality,
+        "requested_quality": quality,
+        "adaptive": adaptive and out_format == "JPEG",
         "download_id": download_id,
         "filename": filename,
     }
@@ -199,36 +622,58 @@ def compress_image():
         "index.html",
         current_year=date.today().year,
         result=result,
-        allowed_formats=sorted(ALLOWED_OUTPUT_FORMATS),
+        allowed_formats=ALLOWED_OUTPUT_FORMATS_SORTED,
+        max_dimension=MAX_OUTPUT_DIMENSION,
     )
 
 
 @app.route("/download/<download_id>", methods=["GET"])
 def download_image(download_id: str):
-    """Serve the compressed image bytes and remove them from cache afterwards.
+    """Serve the compressed image and remove it from the store afterwards.
 
-    This prevents files lingering indefinitely in memory. Also verifies expiry.
+    This prevents files lingering indefinitely on disk. Also verifies expiry.
     """
     _cleanup_expired_cache()
 
+    if app.redis is not None:
+        try:
+            stored = _pop_redis_download(download_id)
+        except Exception as e:
+            flash(f"Error fetching download: {e}", "error")
+            return redirect(url_for("index"))
+        if stored is None:
+            flash("Download is no longer available or has expired.", "error")
+            return redirect(url_for("index"))
+        data, mimetype, filename = stored
+        return send_file(BytesIO(data), mimetype=mimetype, as_attachment=True, download_name=filename)
+
     entry = app.download_cache.pop(download_id, None)
     if entry is None:
         flash("Download is no longer available or has expired.", "error")
         return redirect(url_for("index"))
 
-    compressed_bytes, mimetype, filename, expiry = entry
     # expiry already enforced in cleanup; extra check
-    if expiry <= datetime.utcnow():
+    if entry.expiry <= time.monotonic():
+        _remove_spooled_file(entry.path)
         flash("Download has expired.", "error")
         return redirect(url_for("index"))
 
-    # serve bytes as file-like stream
-    return send_file(
-        BytesIO(compressed_bytes),
-        mimetype=mimetype,
-        as_attachment=True,
-        download_name=filename,
-    )
+    # serve from the path so the server can use sendfile(2); not conditional, since
+    # a Range request would consume the one-shot download with a partial body
+    try:
+        response = send_file(
+            entry.path,
+            mimetype=entry.mimetype,
+            as_attachment=True,
+            download_name=entry.filename,
+            conditional=False,
+        )
+    except FileNotFoundError:
+        flash("Download is no longer available or has expired.", "error")
+        return redirect(url_for("index"))
+    # send_file already holds the file open, so the name can go right away
+    _remove_spooled_file(entry.path)
+    return response
 
 
 # -----------------------
@@ -0,0 +1,46 @@
+"""Gunicorn settings for serving the image compressor.
+
+Usage: gunicorn -c gunicorn_conf.py app:app
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# Without REDIS_URL a download only exists in the worker that handled the upload
+# (see app.py), so default to a single worker and scale with threads instead;
+# encoding still uses every CPU through the app's process pool. With Redis any
+# worker can serve any download, so several workers are safe.
+_cpus = os.cpu_count() or 1
+_shared_downloads = bool(os.environ.get("REDIS_URL"))
+
+workers = int(os.environ.get("WEB_CONCURRENCY", _cpus * 2 + 1 if _shared_downloads else 1))
+worker_class = "gthread"
+threads = 4 if _shared_downloads else max(4, _cpus * 2)
+
+# import the app once in the master
+preload_app = True
+
+
+def when_ready(server):
+    """Warn when several workers run without a shared download store."""
+    if server.cfg.workers > 1 and not _shared_downloads:
+        server.log.warning(
+            "Running %d workers without REDIS_URL: download links only work when the "
+            "request reaches the worker that compressed the image. Set REDIS_URL or "
+            "use a single worker.",
+            server.cfg.workers,
+        )
+
+
+def post_fork(server, worker):
+    """Give every worker its own, smaller encode pool.
+
+    Workers split the CPUs between them instead of each starting
+    os.cpu_count() encoder processes. The size is stored on the app so a pool
+    rebuilt after a crashed encoder keeps it.
+    """
+    import app as image_app
+
+    image_app.app.encode_pool_size = max(1, (os.cpu_count() or 1) // server.cfg.workers)
+    # the pool itself is started lazily on this worker's first upload
+    image_app.app.encode_pool = None